@@ -2,21 +2,76 @@
 import os
 import re
 import csv
-import time
+import gzip
+import zlib
+import sqlite3
+import asyncio
+import threading
 import argparse
-import requests
-from typing import List, Optional
-from bs4 import BeautifulSoup
+import aiohttp
+from aiolimiter import AsyncLimiter
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Deque, Dict, List, Optional, Set, Tuple
+from lxml import etree
+
+
+# HTTP client settings: (connect, read) timeouts and retries with exponential backoff
+_REQUEST_TIMEOUT = aiohttp.ClientTimeout(sock_connect=5, sock_read=30)
+_MAX_RETRIES = 3
+_RETRY_BACKOFF = 0.5
+
+# Politeness budget for the 3CX API, shared by all concurrent requests (including retries)
+_RATE_LIMITER = AsyncLimiter(max_rate=4, time_period=1.0)
+
+_DEFAULT_HEADERS = {
+    "accept": "/",
+    "accept-language": "en-US,en;q=0.9",
+    "cache-control": "no-cache",
+    "content-type": "application/x-www-form-urlencoded; charset=UTF-8",
+    "origin": "https://www.3cx.com",
+    "pragma": "no-cache",
+    "referer": "https://www.3cx.com/ordering/find-reseller/",
+    "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36",
+    "x-requested-with": "XMLHttpRequest"
+}
+
+_OUTPUT_BUFFER_SIZE = 1 << 20
+# Characters that force a CSV field to be quoted
+_CSV_QUOTE_CHARS = (",", '"', "\r", "\n")
+
+# Known partner levels by the word in "3CX <Level> Partners"; other headers fall back to _LEVEL_RE
+_PARTNER_LEVELS = {
+    level: f"{level} Partners"
+    for level in ("Titanium", "Platinum", "Gold", "Silver", "Bronze", "Preferred", "Certified")
+}
+_LEVEL_RE = re.compile(r"3CX\s+([\w\s]+)\s+Partners")
+_KNOWN_PARTNER_LEVELS = frozenset(_PARTNER_LEVELS.values()) | {"Unknown"}
+
+# XPath expressions used by the partner parser
+# Partner level headers and partner containers, in document order
+_SECTION_EXPR = "//h3 | //div[contains(concat(' ', normalize-space(@class), ' '), ' xcx_partner_category_row ')]"
+_PARTNER_BOX_EXPR = ".//div[contains(concat(' ', normalize-space(@class), ' '), ' xcx_partner_box ')]"
+_COMPANY_NAME_EXPR = "(.//a)[1]//strong"
+_FLEX_DIV_EXPR = ".//div[contains(@style, 'display:flex')]"
+
+# Holds the lxml parser and compiled XPath selectors of each thread: parser instances must not be
+# shared between threads, and every XPath object serialises its evaluations behind its own lock
+_thread_state = threading.local()
 
 
 class Location:
     """Represents a location for partner search."""
+    __slots__ = ("country", "country_code", "region", "region_code", "city", "cache_key")
+
     def __init__(self, country: str, country_code: str, region: str, region_code: str, city: Optional[str] = None):
         self.country = country
         self.country_code = country_code
         self.region = region
         self.region_code = region_code
         self.city = city
+        # Key of this location's page in the HTML cache, computed once as it is looked up repeatedly
+        self.cache_key = (country_code, region_code, city or "")
 
     def __str__(self) -> str:
         if self.city:
@@ -26,6 +81,9 @@ class Location:
 
 class Partner:
     """Represents a 3CX partner."""
+    __slots__ = ("country", "state", "city", "partner_level", "company_name", "telephone", "website", "address",
+                 "partner_id")
+
     def __init__(self, country: str, state: str, city: Optional[str], partner_level: str,
                  company_name: str, telephone: str, website: str, address: str, partner_id: str):
         self.country = country
@@ -56,46 +114,60 @@ class Partner:
 def read_locations_from_csv(filename: str) -> List[Location]:
     """Reads locations from a CSV file."""
     locations = []
+    append = locations.append
     with open(filename, 'r', encoding='utf-8') as file:
         reader = csv.reader(file)
         # Skip header
         next(reader)
         for row in reader:
-            if len(row) < 4:
-                continue
-            country = row[0]
-            country_code = row[1]
-            region = row[2]
-            region_code = row[3]
-            city = row[4] if len(row) > 4 and row[4] else None
-            locations.append(Location(country, country_code, region, region_code, city))
+            try:
+                append(Location(row[0], row[1], row[2], row[3], row[4] or None))
+            except IndexError:
+                # Rows without a city column are still valid, shorter ones are skipped
+                if len(row) == 4:
+                    append(Location(row[0], row[1], row[2], row[3]))
     return locations
 
 
-def get_cache_filename(location: Location, cache_dir: str) -> str:
-    """Returns the cache filename for HTML storage."""
-    city_part = f"_{location.city.replace(' ', '_')}" if location.city else "_"
-    filename = f"{location.country_code}_{location.region_code}{city_part}.html"
-    return os.path.join(cache_dir, filename)
+class HtmlCache:
+    """Stores gzip-compressed HTML responses in a single SQLite database."""
+    def __init__(self, filename: str):
+        self.connection = sqlite3.connect(filename, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages (cc TEXT, rc TEXT, city TEXT, body BLOB, PRIMARY KEY (cc, rc, city))")
+
+    def read(self, location: Location) -> Optional[bytes]:
+        """Reads cached HTML (UTF-8 bytes) for a location."""
+        row = self.connection.execute(
+            "SELECT body FROM pages WHERE cc = ? AND rc = ? AND city = ?", location.cache_key).fetchone()
+        if row is None:
+            return None
+        try:
+            return gzip.decompress(row[0])
+        except (IOError, EOFError, zlib.error):
+            # A damaged entry is treated as a cache miss, so the page is fetched again
+            return None
 
+    def save(self, location: Location, html: bytes) -> None:
+        """Saves HTML (UTF-8 bytes) for a location."""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO pages (cc, rc, city, body) VALUES (?, ?, ?, ?)",
+            (*location.cache_key, gzip.compress(html, compresslevel=3)))
 
-def read_cached_html(filename: str) -> Optional[str]:
-    """Reads cached HTML from a file."""
-    try:
-        with open(filename, 'r', encoding='utf-8') as file:
-            return file.read()
-    except (IOError, FileNotFoundError):
-        return None
+    def close(self) -> None:
+        self.connection.close()
 
+    def __enter__(self) -> "HtmlCache":
+        return self
 
-def save_cached_html(filename: str, html: str) -> None:
-    """Saves HTML to a cache file."""
-    with open(filename, 'w', encoding='utf-8') as file:
-        file.write(html)
+    def __exit__(self, *exc_info) -> None:
+        self.close()
 
 
-def fetch_html(location: Location, include_headers: bool) -> str:
-    """Sends a request to the 3CX API and returns the HTML response."""
+async def fetch_html(session: aiohttp.ClientSession, location: Location, include_headers: bool) -> bytes:
+    """Sends a request to the 3CX API and returns the HTML response as UTF-8 bytes."""
     url = "https://www.3cx.com/resellers/xcx-get-partners/"
     # Prepare form data
     form_data = {
@@ -106,101 +178,189 @@ def fetch_html(location: Location, include_headers: bool) -> str:
     if location.city:
         form_data["city"] = location.city
 
-    # Prepare headers
-    headers = {}
-    if include_headers:
-        headers = {
-            "accept": "/",
-            "accept-language": "en-US,en;q=0.9",
-            "cache-control": "no-cache",
-            "content-type": "application/x-www-form-urlencoded; charset=UTF-8",
-            "origin": "https://www.3cx.com",
-            "pragma": "no-cache",
-            "referer": "https://www.3cx.com/ordering/find-reseller/",
-            "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36",
-            "x-requested-with": "XMLHttpRequest"
-        }
-
-    response = requests.post(url, data=form_data, headers=headers)
-    response.raise_for_status()
-    return response.text
-
-
-def parse_partners_from_html(html: str, location: Location) -> List[Partner]:
-    """Parses HTML and extracts partner information."""
-    soup = BeautifulSoup(html, "html.parser")
+    # Headers are shared between requests and never mutated
+    headers = _DEFAULT_HEADERS if include_headers else None
+
+    for attempt in range(_MAX_RETRIES + 1):
+        try:
+            async with _RATE_LIMITER, session.post(url, data=form_data, headers=headers) as response:
+                response.raise_for_status()
+                html = await response.read()
+                # The parser and the cache expect UTF-8, re-encode anything else
+                if response.charset and response.charset.lower() not in ("utf-8", "utf8"):
+                    html = html.decode(response.charset).encode("utf-8")
+                return html
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Only connection problems, timeouts and server errors are worth retrying
+            retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status >= 500
+            if not retryable or attempt == _MAX_RETRIES:
+                raise
+            await asyncio.sleep(_RETRY_BACKOFF * 2 ** attempt)
+
+
+def _get_parser_state() -> threading.local:
+    """Returns the HTML parser and compiled XPath selectors of the current thread."""
+    state = _thread_state
+    if not hasattr(state, "html_parser"):
+        # Cached pages are UTF-8 bytes, which are handed to lxml without decoding them first
+        state.html_parser = etree.HTMLParser(encoding="utf-8")
+        state.section_xpath = etree.XPath(_SECTION_EXPR)
+        state.partner_box_xpath = etree.XPath(_PARTNER_BOX_EXPR)
+        state.company_name_xpath = etree.XPath(_COMPANY_NAME_EXPR)
+        state.flex_div_xpath = etree.XPath(_FLEX_DIV_EXPR)
+    return state
+
+
+def _get_text(element, separator: str = "") -> str:
+    """Joins the stripped text fragments of an element (like BeautifulSoup's get_text(strip=True))."""
+    return separator.join(text for text in (t.strip() for t in element.itertext()) if text)
+
+
+def _get_partner_level(header_text: str) -> str:
+    """Returns the partner level named by a header such as "3CX Gold Partners"."""
+    words = header_text.split()
+    if len(words) == 3 and words[0] == "3CX" and words[2] == "Partners" and words[1] in _PARTNER_LEVELS:
+        return _PARTNER_LEVELS[words[1]]
+
+    level_match = _LEVEL_RE.search(header_text)
+    if not level_match:
+        return "Unknown"
+    return level_match.group(1) + " Partners"
+
+
+# Location-independent partner fields: partner level, company name, telephone, website, address, partner ID
+PartnerFields = Tuple[str, str, str, str, str, str]
+
+
+def parse_partner_fields(html: bytes) -> List[PartnerFields]:
+    """Parses HTML (UTF-8 bytes) and extracts the location-independent partner fields."""
+    # Pages for regions without partners have no partner boxes at all, so they are not worth parsing
+    if b"xcx_partner_box" not in html:
+        return []
+
+    state = _get_parser_state()
+    root = etree.HTML(html, state.html_parser)
     partners = []
+    if root is None:
+        return partners
+
+    # Walk headers and containers in a single pass: each container belongs to the closest header above it
+    partner_level = None
+    for section in state.section_xpath(root):
+        if section.tag == "h3":
+            # Extract partner level (removing <img>)
+            partner_level = _get_partner_level(_get_text(section, " "))
+            continue
 
-    # Find all partner level headers
-    h3_tags = soup.find_all("h3")
-    for h3 in h3_tags:
-        # Extract partner level (removing <img>)
-        partner_level_text = h3.get_text(" ", strip=True)
-        level_match = re.search(r"3CX\s+([\w\s]+)\s+Partners", partner_level_text)
-        partner_level = level_match.group(1) + " Partners" if level_match else "Unknown"
-
-        # Find the container with partners below the header
-        partner_container = h3.find_next("div", class_="xcx_partner_category_row")
-        if not partner_container:
+        # Containers without a header above them are not partner listings
+        if partner_level is None:
             continue
 
         # Find all partner boxes
-        partner_boxes = partner_container.find_all("div", class_="xcx_partner_box")
-        for box in partner_boxes:
+        for box in state.partner_box_xpath(section):
             # Company name
-            company_name_elem = box.find("a")
-            company_name = (company_name_elem.find("strong").get_text(strip=True)
-                            if company_name_elem else "Unknown")
+            company_name_elem = state.company_name_xpath(box)
+            company_name = _get_text(company_name_elem[0]) if company_name_elem else "Unknown"
             # Extract all flex blocks (with inline style "display:flex")
-            flex_divs = box.find_all("div", style=lambda value: value and "display:flex" in value)
+            flex_divs = state.flex_div_xpath(box)
             if len(flex_divs) >= 4:
-                telephone = flex_divs[0].get_text(strip=True)
-                website = flex_divs[1].get_text(strip=True)
-                address = flex_divs[2].get_text(strip=True)
-                partner_id_text = flex_divs[3].get_text(strip=True)
+                telephone = _get_text(flex_divs[0])
+                website = _get_text(flex_divs[1])
+                address = _get_text(flex_divs[2])
+                partner_id_text = _get_text(flex_divs[3])
                 partner_id = partner_id_text.replace("Partner ID:", "").strip()
             else:
                 telephone = website = address = partner_id = ""
 
-            partner = Partner(
-                country=location.country,
-                state=location.region,
-                city=location.city,
-                partner_level=partner_level,
-                company_name=company_name,
-                telephone=telephone,
-                website=website,
-                address=address,
-                partner_id=partner_id
-            )
-            partners.append(partner)
+            partners.append((partner_level, company_name, telephone, website, address, partner_id))
     return partners
 
 
-def get_partners_with_cache(location: Location, include_headers: bool, cache_dir: str, use_cache: bool) -> List[Partner]:
-    """Gets partners using cached HTML responses when available."""
-    cache_file = get_cache_filename(location, cache_dir)
+def stamp_partners(fields: List[PartnerFields], location: Location) -> List[Partner]:
+    """Combines parsed partner fields with the location they were found for."""
+    return [Partner(location.country, location.region, location.city, *partner_fields) for partner_fields in fields]
+
+
+def parse_partners_from_html(html: bytes, location: Location) -> List[Partner]:
+    """Parses HTML (UTF-8 bytes) and extracts partner information."""
+    return stamp_partners(parse_partner_fields(html), location)
+
+
+async def get_html_with_cache(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, location: Location,
+                              include_headers: bool, cache: HtmlCache, use_cache: bool) -> Optional[bytes]:
+    """Gets the HTML for a location, using cached HTML responses when available."""
     html_content = None
 
     # Check for cache
     if use_cache:
-        html_content = read_cached_html(cache_file)
+        html_content = cache.read(location)
         if html_content:
             print(f"[cached for] {location}")
 
-    # If no cache, fetch HTML
+    # If no cache, fetch HTML (the semaphore bounds the number of requests in flight)
     if not html_content:
         try:
-            html_content = fetch_html(location, include_headers)
-            time.sleep(0.5)
+            async with semaphore:
+                html_content = await fetch_html(session, location, include_headers)
             print(f"[NOT CACHED for] {location}")
-            save_cached_html(cache_file, html_content)
-            print(f"[SAVE for] {cache_file}")
+            cache.save(location, html_content)
+            print(f"[SAVE for] {location}")
         except Exception as e:
             print(f"Error fetching HTML for {location}: {str(e)}")
-            return []
+            return None
+
+    return html_content
+
+
+async def fetch_all_html(locations: List[Location], include_headers: bool, cache: HtmlCache, use_cache: bool,
+                         concurrency: int) -> List[Optional[bytes]]:
+    """Gets the HTML for all locations concurrently, preserving the order of locations."""
+    semaphore = asyncio.Semaphore(concurrency)
+    # Keep-alive connections are pooled and reused across all requests
+    connector = aiohttp.TCPConnector(limit=concurrency, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector, timeout=_REQUEST_TIMEOUT) as session:
+        return await asyncio.gather(*[
+            get_html_with_cache(session, semaphore, location, include_headers, cache, use_cache)
+            for location in locations
+        ])
 
-    return parse_partners_from_html(html_content, location)
+
+def _format_csv_field(field: str) -> str:
+    """Quotes a CSV field only when needed (same rules as csv.writer's QUOTE_MINIMAL)."""
+    if any(char in field for char in _CSV_QUOTE_CHARS):
+        return '"' + field.replace('"', '""') + '"'
+    return field
+
+
+def encode_csv_rows(rows: List[List[str]]) -> bytes:
+    """Formats rows as CSV (matching csv.writer's default dialect) and encodes them to UTF-8 in a single pass."""
+    return "".join([",".join(map(_format_csv_field, row)) + "\r\n" for row in rows]).encode("utf-8")
+
+
+def _parse_one(task: Tuple[List[Location], Optional[bytes]]) -> Tuple[List[bytes], Set[str]]:
+    """Parses a page shared by one or more locations into encoded CSV rows per location (runs in a worker process).
+
+    Also returns the partner levels missing from _PARTNER_LEVELS, so the main process can report them once.
+    """
+    locations, html_content = task
+    if not html_content:
+        return [b""] * len(locations), set()
+    # The page is parsed once, then stamped with each location's own metadata
+    fields = parse_partner_fields(html_content)
+    new_levels = {partner_fields[0] for partner_fields in fields} - _KNOWN_PARTNER_LEVELS
+    return [encode_csv_rows([partner.to_csv_row() for partner in stamp_partners(fields, location)])
+            for location in locations], new_levels
+
+
+def _positive_int(value: str) -> int:
+    """Parses a command-line value that must be an integer of at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 
 def main():
@@ -208,11 +368,14 @@ def main():
     parser.add_argument("-i", "--input", default="locations.csv", help="Input CSV file with locations")
     parser.add_argument("-o", "--output", default="partners.csv", help="Output CSV file for partners")
     parser.add_argument("--headers", action="store_true", default=True, help="Include headers in HTTP request")
-    parser.add_argument("--cache", default="html_cache", help="Directory for storing cached HTML responses")
+    parser.add_argument("--cache", default="html_cache.sqlite", help="SQLite database (or directory to hold it) for storing cached HTML responses")
     parser.add_argument("--use-cache", action="store_true", default=True, help="Use cached HTML responses")
+    parser.add_argument("--concurrency", type=_positive_int, default=16, help="Maximum number of concurrent HTTP requests")
     args = parser.parse_args()
 
-    os.makedirs(args.cache, exist_ok=True)
+    # --cache used to name a directory, so an existing directory gets the database inside it
+    if os.path.isdir(args.cache):
+        args.cache = os.path.join(args.cache, "html_cache.sqlite")
 
     try:
         locations = read_locations_from_csv(args.input)
@@ -220,13 +383,62 @@ def main():
         print(f"Error reading locations: {str(e)}")
         return
 
-    with open(args.output, 'w', encoding='utf-8', newline='') as output_file:
-        writer = csv.writer(output_file)
-        writer.writerow(["Country", "State", "City", "Partner Level", "Company Name", "Telephone", "Website", "Address", "Partner ID"])
-        for location in locations:
-            partners = get_partners_with_cache(location, args.headers, args.cache, args.use_cache)
-            for partner in partners:
-                writer.writerow(partner.to_csv_row())
+    # Locations with the same cache key share one request and one parse
+    groups: Dict[Tuple[str, str, str], List[int]] = {}
+    for index, location in enumerate(locations):
+        groups.setdefault(location.cache_key, []).append(index)
+    group_indices = list(groups.values())
+
+    try:
+        cache_dir = os.path.dirname(args.cache)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        cache = HtmlCache(args.cache)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Error opening cache {args.cache}: {str(e)}")
+        return
+
+    with cache:
+        unique_locations = [locations[indices[0]] for indices in group_indices]
+        pages = asyncio.run(fetch_all_html(unique_locations, args.headers, cache, args.use_cache, args.concurrency))
+
+    # The output is written as pre-encoded bytes, one batch per location, through a large write buffer
+    with open(args.output, 'wb', buffering=_OUTPUT_BUFFER_SIZE) as output_file:
+        output_file.write(encode_csv_rows([
+            ["Country", "State", "City", "Partner Level", "Company Name", "Telephone", "Website", "Address", "Partner ID"]
+        ]))
+        pending_rows: Dict[int, bytes] = {}
+        next_index = 0
+        reported_levels: Set[str] = set()
+        in_flight: Deque[Tuple[List[int], Future]] = deque()
+
+        def write_finished(max_in_flight: int) -> None:
+            """Writes the oldest parsed groups until at most max_in_flight remain, keeping input order."""
+            nonlocal next_index
+            while len(in_flight) > max_in_flight:
+                indices, future = in_flight.popleft()
+                group_rows, new_levels = future.result()
+                # Report unknown levels once so they can be added to _PARTNER_LEVELS
+                for level in sorted(new_levels - reported_levels):
+                    reported_levels.add(level)
+                    print(f"[new partner level] {level}")
+                # Only the batches of later duplicate locations have to wait for the rows before them
+                for index, rows in zip(indices, group_rows):
+                    pending_rows[index] = rows
+                while next_index in pending_rows:
+                    output_file.write(pending_rows.pop(next_index))
+                    next_index += 1
+
+        # Parsing is CPU-bound and mostly runs Python code under the GIL, so it is spread over worker processes.
+        # Only a small window of groups is in flight, so finished pages and their batches are freed as the run goes
+        max_workers = os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for group, indices in enumerate(group_indices):
+                future = executor.submit(_parse_one, ([locations[index] for index in indices], pages[group]))
+                pages[group] = None
+                in_flight.append((indices, future))
+                write_finished(2 * max_workers)
+            write_finished(0)
 
     print(f"Done! Partners saved to {args.output}")
 
@@ -1,20 +1,27 @@
+import gzip
+import sqlite3
 from pathlib import Path
 from bs4 import BeautifulSoup
 
-# HTML cache file
-cache_file = Path("html_cache/AE_RK_.html")
+# HTML cache database
+cache_db = Path("html_cache.sqlite")
 
-# Check if the file exists
-if not cache_file.exists():
-    print(f"File {cache_file} not found!")
+# Check if the database exists
+if not cache_db.exists():
+    print(f"File {cache_db} not found!")
     exit(1)
 
-# Read the file content
-with cache_file.open("r", encoding="utf-8") as file:
-    html_content = file.read()
+# Read the cached page content
+connection = sqlite3.connect(cache_db)
+row = connection.execute("SELECT body FROM pages WHERE cc = ? AND rc = ? AND city = ?", ("AE", "RK", "")).fetchone()
+connection.close()
+if row is None:
+    print(f"Page AE_RK_ not found in {cache_db}!")
+    exit(1)
+html_content = gzip.decompress(row[0])
 
 # Parse HTML using BeautifulSoup
-soup = BeautifulSoup(html_content, "html.parser")
+soup = BeautifulSoup(html_content, "lxml", from_encoding="utf-8")
 
 # Print partner level headers
 h3_tags = soup.find_all("h3")